@@ -1,5 +1,6 @@
 import jax
 import flax
+import optax
 import jax.numpy as jnp
 import flax.linen as nn
 
@@ -12,9 +13,15 @@ from matplotlib import pyplot as plt
 
 print('Jax version', jax.__version__)
 print('Flax version', flax.__version__)
+# Persist compiled XLA executables across runs (sweeps, resumed training, ...).
+# Entries are keyed by jax/jaxlib version, so upgrading simply recompiles.
+# Only when run as a script: importing this module leaves the jax config untouched
+if __name__ == "__main__":
+    jax.config.update("jax_compilation_cache_dir", os.path.expanduser("~/.cache/jax_glow"))
 random_key = jax.random.PRNGKey(0)
 
 from layers import squeeze, unsqueeze
+from layers import split_channels
 from layers import Split
 from layers import ActNorm, Conv1x1, AffineCoupling
 
@@ -22,6 +29,7 @@ from model import FlowStep, GLOW
 
 from utils import summarize_jax_model
 from utils import plot_image_grid
+from utils import prefetch_to_device
 
 """This notebook contains an introduction of the paper [Glow: Generative Flow with Invertible 1×1 Convolutions](https://arxiv.org/pdf/1807.03039.pdf) with an implementation in `jax`. It also incorporates some of the "tricks" from the authors' original [tensorflow repository](https://github.com/openai/glow/blob/master/model.py#L559), though not all of them (e.g. `logscale_factor`).
 
@@ -49,18 +57,19 @@ Similar to [Real NVP](https://arxiv.org/abs/1605.08803), the Glow architecture h
 The goal of the squeeze operation is to trade-off spatial dimensions for channel dimensions; This preserves information, but has an impact on the field of view and computational efficiency (larger matrix multiplicatoins but fewer convolutional operations). `squeeze` simply splits the feature maps in `2x2xc` blocks and flatten each block to shape `1x1x4c`.
 """
 
-print("Example")
-x = jax.random.randint(random_key, (1, 4, 4, 1), 0, 10)
-print('x = ', '\n     '.join(' '.join(str(v[0]) for v in row) for row in x[0]))
-print('\nbecomes\n')
-x = squeeze(x)
-print('y with shape', x.shape, 'where')
-print('\n'.join(f'  y[{i}, {j}] = {x[0, i, j]}' for i in range(2) for j in range(2)))
+def squeeze_example():
+    print("Example")
+    x = jax.random.randint(random_key, (1, 4, 4, 1), 0, 10)
+    print('x = ', '\n     '.join(' '.join(str(v[0]) for v in row) for row in x[0]))
+    print('\nbecomes\n')
+    x = squeeze(x)
+    print('y with shape', x.shape, 'where')
+    print('\n'.join(f'  y[{i}, {j}] = {x[0, i, j]}' for i in range(2) for j in range(2)))
 
 """And we can of course implement the reverse operation as follows:"""
 
-print("Sanity check for  reversibility")
-def sanity_check():
+def sanity_check_squeeze():
+    print("Sanity check for  reversibility")
     x = jax.random.randint(random_key, (1, 4, 4, 16), 0, 10)
     y = unsqueeze(squeeze(x))
     z = squeeze(unsqueeze(x))
@@ -68,7 +77,6 @@ def sanity_check():
           "unsqueeze o squeeze = id")
     print("  \033[92m✓\033[0m" if np.array_equal(x, z) else "  \033[91mx\033[0m", 
           "squeeze o unsqueeze = id")
-sanity_check()
 
 """### Split
 
@@ -85,7 +93,7 @@ Where $z_i$ are the latent variables of the model.
 """
 
 def split(x):
-    return jnp.split(x, 2, axis=-1)
+    return split_channels(x)
 
 def unsplit(x, z):
     return jnp.concatenate([z, x], axis=-1)
@@ -163,9 +171,8 @@ $\log \det \mbox{ActNorm} = h \times w \times \sum \log (| \sigma |)$
 Note that $\mu$ and $\sigma$ are trainable variables (contrary to batch norm) and are initialized in a data-dependant manner, such that the first batch of data used for initialization is normalized to zero-mean and unit-variance.
 """
 
-print("Sanity check for data-dependant init in ActNorm")
-
-def sanity_check():
+def sanity_check_actnorm():
+    print("Sanity check for data-dependant init in ActNorm")
     x = jax.random.normal(random_key, (1, 256, 256, 3))
     model = ActNorm()
     init_variables = model.init(random_key, x)
@@ -174,7 +181,6 @@ def sanity_check():
     print("  \033[92m✓\033[0m" if abs(m) < eps else "  \033[91mx\033[0m", "Mean:", m)
     print("  \033[92m✓\033[0m" if abs(v  - 1) < eps else "  \033[91mx\033[0m",
           "Standard deviation", v)
-sanity_check()
 
 """### Invertible Convolution
 
@@ -205,16 +211,14 @@ def summary():
     model = FlowStep(key=random_key)
     init_variables = model.init(random_key, x)
     summarize_jax_model(init_variables, max_depth=2)
-summary()
 
 """## Final model
 
 Once we have the flow step definition, we can finally buid the multi-scale Glow architecture. The naming of the different modules is important as it guarantees that the parameters are shared adequately between the forward and reverse pass.
 """
 
-print("Sanity check for reversibility (no sampling in reverse pass)")
-
-def sanity_check():
+def sanity_check_glow():
+    print("Sanity check for reversibility (no sampling in reverse pass)")
     # Input
     x_1 = jax.random.normal(random_key, (32, 32, 32, 6))
     K, L = 16, 3
@@ -256,7 +260,20 @@ def sanity_check():
     diff = jnp.mean(jnp.abs(x_1 - x_3))
     print("  \033[92m✓\033[0m" if diff < 1e-4 else "  \033[91mx\033[0m", 
           f"Diff between x and Glow_r o Glow (x) = {diff:.3e}")
-sanity_check()
+
+
+def _sanity():
+    """Run all the examples and sanity checks above. These trigger many
+    small jit compilations, hence they are only run on demand"""
+    squeeze_example()
+    sanity_check_squeeze()
+    sanity_check_actnorm()
+    summary()
+    sanity_check_glow()
+
+# e.g. GLOW_SANITY=1 python glow_model.py
+if __name__ == "__main__" and os.environ.get("GLOW_SANITY"):
+    _sanity()
 
 """# Training the model
 
@@ -268,20 +285,33 @@ Following equation (1), we now only need to compute the likelihood of the latent
 Since each $p(z)$ is a Gaussian by definition, the corresponding likelihood is easy to estimate:
 """
 
-@jax.vmap
+# Gaussian normalization constant, as a float32 scalar to avoid any float64 promotion
+_HALF_LOG_2PI = np.float32(0.5 * np.log(2 * np.pi))
+
+
+def per_scale_logpz(zi, priori):
+    """Per-sample log-likelihood of the latent zi under its Gaussian prior,
+    or under a standard Gaussian if `priori` is None. The normalization
+    constant -0.5 * log(2 pi) per dimension is left out (see get_logpz)"""
+    if priori is None:
+        term = - 0.5 * zi * zi
+    else:
+        mu, logsigma = split_channels(priori)
+        diff = (zi - mu) * jnp.exp(- logsigma)
+        term = - logsigma - 0.5 * diff * diff
+    return jnp.sum(term, axis=tuple(range(1, zi.ndim)))
+
+
 def get_logpz(z, priors):
-    logpz = 0
-    for zi, priori in zip(z, priors):
-        if priori is None:
-            mu = jnp.zeros(zi.shape)
-            logsigma = jnp.zeros(zi.shape)
-        else:
-            mu, logsigma = jnp.split(priori, 2, axis=-1)
-        logpz += jnp.sum(- logsigma - 0.5 * jnp.log(2 * jnp.pi) 
-                         - 0.5 * (zi - mu) ** 2 / jnp.exp(2 * logsigma))
-    return logpz
-
-"""**Note on jax.vmap:** The `vmap` function decorator can be used to indicate that a function should be vectorized across a given axis of its inputs (default is first axis). This is very useful to model a function that can be parallelized across a batch, e.g. a loss function like here or metrics.
+    """Per-sample log-likelihood of all latents z. The loop over scales is
+    unrolled at trace time (priors is a static list)"""
+    num_dims = sum(int(np.prod(zi.shape[1:])) for zi in z)
+    logpz = sum(per_scale_logpz(zi, priori) for zi, priori in zip(z, priors))
+    return logpz - num_dims * _HALF_LOG_2PI
+
+"""**Note on batching:** Rather than `jax.vmap`-ing over samples, the reduction is directly written over the batch (summing over all but the first axis); this lets XLA fuse the whole log-likelihood computation inside the jitted loss.
+
+Similarly, when the top prior is not learned (`priori is None`), the branch is resolved in Python at trace time: the standard Gaussian log-likelihood $- \frac{1}{2} z^2$ is computed directly, rather than materializing zero-valued $\mu$ and $\log \sigma$ tensors. The constant $- \frac{1}{2}\log(2\pi)$ term is the same for every dimension, hence it is added once for all latents, as a scalar, instead of element-wise.
 
 ### Dequantization
 
@@ -290,31 +320,41 @@ In [A note on the evaluation of generative models](https://arxiv.org/pdf/1511.01
 In the original Glow implementation, they also introduce a `num_bits` parameter which allows for further controlling the quantization level of the input images (8 = standard `uint8`, 0 = binary images)
 """
 
-def map_fn(image_path, num_bits=5, size=256, training=True):
-    """Read image file, quantize and map to [-0.5, 0.5] range.
-    If num_bits = 8, there is no quantization effect."""
-    image = tf.io.decode_jpeg(tf.io.read_file(image_path))
-    # Resize input image
-    image = tf.cast(image, tf.float32)
-    image = tf.image.resize(image, (size, size))
+def decode_resize_fn(image_path, num_bits=5, size=256):
+    """Read image file, resize and quantize to the given number of bits (uint8).
+    Deterministic, hence its outputs can be cached across epochs.
+    If num_bits = 8, there is no quantization effect (the resized float32 image
+    is returned as is)."""
+    image = tf.io.decode_jpeg(tf.io.read_file(image_path), channels=3)
+    # Resize input image directly from uint8 (area resampling averages the source
+    # pixels, which suits downsizing); the output is float32
+    image = tf.image.resize(image, (size, size), method=tf.image.ResizeMethod.AREA)
     image = tf.clip_by_value(image, 0., 255.)
-    # Discretize to the given number of bits
-    if num_bits < 8:
-        image = tf.floor(image / 2 ** (8 - num_bits))
+    if num_bits >= 8:
+        return image
+    # Discretize to the given number of bits: casting to uint8 floors the
+    # (positive) values, then dropping the lowest bits is a right shift
+    image = tf.cast(image, tf.uint8)
+    return tf.bitwise.right_shift(image, tf.constant(8 - num_bits, dtype=tf.uint8))
+
+
+def dequantize_noise_fn(image, num_bits=5, training=True):
+    """Map a batch of quantized images to [-0.5, 0.5] range.
+    When training, add uniform dequantization noise."""
+    inv_num_bins = 1. / 2 ** num_bits
     # Send to [-1, 1]
-    num_bins = 2 ** num_bits
-    image = image / num_bins - 0.5
+    image = tf.cast(image, tf.float32) * inv_num_bins - 0.5
     if training:
-        image = image + tf.random.uniform(tf.shape(image), 0, 1. / num_bins)
+        image = image + tf.random.uniform(tf.shape(image), 0, inv_num_bins)
     return image
 
 
-@jax.jit
+@partial(jax.jit, static_argnums=1)
 def postprocess(x, num_bits):
     """Map [-0.5, 0.5] quantized images to uint space"""
     num_bins = 2 ** num_bits
-    x = jnp.floor((x + 0.5) * num_bins)
-    x *= 256. / num_bins
+    x = jnp.floor((x + 0.5) * num_bins).astype(jnp.int32)
+    x = x * (256 // num_bins)
     return jnp.clip(x, 0, 255).astype(jnp.uint8)
 
 """**Note on jax.jit**: The `jit` decorator is essentially an optimization that compiles a block of operations acting on the same device together. See also the [jax doc](https://jax.readthedocs.io/en/latest/notebooks/quickstart.html)
@@ -326,6 +366,16 @@ Drawing a parallel to the standard VAE, we can see the *encoder* as a forward pa
 In other words, we only need the encoder for the training phase. The "decoder" (i.e., reverse Glow) is used for sampling only. A sampling pass is thus:
 """
 
+def make_reverse_fn(model):
+    """Jitted reverse pass of the model, `reverse_fn(params, zL, eps, sampling_temperature)`.
+    The temperature is traced, hence it is compiled only once per latent shape"""
+    @jax.jit
+    def reverse_fn(params, zL, eps, sampling_temperature):
+        return model.apply(params, zL, eps=eps, sampling_temperature=sampling_temperature,
+                           reverse=True)[0]
+    return reverse_fn
+
+
 def sample(model, 
            params, 
            eps=None, 
@@ -334,13 +384,18 @@ def sample(model,
            key=jax.random.PRNGKey(0),
            postprocess_fn=None, 
            save_path=None,
-           display=True):
-    """Sampling only requires a call to the reverse pass of the model"""
+           display=True,
+           reverse_fn=None):
+    """Sampling only requires a call to the reverse pass of the model.
+    If given, `reverse_fn` (see `make_reverse_fn`) is used instead of `model.apply`"""
     if eps is None:
         zL = jax.random.normal(key, shape) 
     else: 
         zL = eps[-1]
-    y, *_ = model.apply(params, zL, eps=eps, sampling_temperature=sampling_temperature, reverse=True)
+    if reverse_fn is None:
+        y, *_ = model.apply(params, zL, eps=eps, sampling_temperature=sampling_temperature, reverse=True)
+    else:
+        y = reverse_fn(params, zL, eps, sampling_temperature)
     if postprocess_fn is not None:
         y = postprocess_fn(y)
     plot_image_grid(y, save_path=save_path, display=display,
@@ -366,6 +421,12 @@ def train_glow(train_ds,
                nn_width=512,
                sampling_temperature=0.7,
                learn_top_prior=True,
+               grad_accum_steps=1,
+               steps_per_call=1,
+               remat=False,
+               dtype=jnp.float32,
+               scan_flows=False,
+               log_every=50,
                key=jax.random.PRNGKey(0),
                **kwargs):
     """Simple training loop.
@@ -389,6 +450,22 @@ def train_glow(train_ds,
             Gaussian priors (1 = no effect)
         learn_top_prior: Whether to learn the prior for highest latent variable zL.
             Otherwise, assumes standard unit Gaussian prior
+        grad_accum_steps: Number of microbatches each batch is split into; their
+            gradients are accumulated before a single optimizer update. The
+            batch size must be divisible by this value (and by the number of devices)
+        steps_per_call: Number of optimizer steps run inside a single compiled call
+            (lax.scan over that many stacked batches). Logging, NaN checks and
+            sampling happen at most once per call
+        remat: Whether to rematerialize the coupling layers activations during
+            the backward pass (lower memory, more compute)
+        dtype: Computation dtype of the coupling layers' hidden convolutions and
+            of the invertible 1x1 convolutions (e.g. jnp.bfloat16); parameters,
+            logdets and log p(z) stay float32
+        scan_flows: Whether to run the K flow steps of each scale with nn.scan,
+            which compiles a single flow step instead of K (parameters are
+            then stacked, hence not compatible with non-scanned weights)
+        log_every: Fetch the loss from device, print it and check for NaNs
+            at this interval (in steps). Avoids a host sync at every step
         key: Random seed
     """
     del kwargs
@@ -397,52 +474,105 @@ def train_glow(train_ds,
                  L=L, 
                  nn_width=nn_width, 
                  learn_top_prior=learn_top_prior,
+                 remat=remat,
+                 dtype=dtype,
+                 scan_flows=scan_flows,
                  key=key)
     
     # Init optimizer and learning rate schedule
     params = model.init(random_key, next(train_ds))
-    opt = flax.optim.Adam(learning_rate=init_lr).create(params)
     
-    def lr_warmup(step):
-        return init_lr * jnp.minimum(1., step / (num_warmup_epochs * steps_per_epoch + 1e-8))
+    lr_warmup = optax.linear_schedule(init_value=0., end_value=init_lr,
+                                      transition_steps=max(1, int(num_warmup_epochs * steps_per_epoch)))
+    
+    # Adam with first moment stored in bfloat16 (halves that part of the optimizer state)
+    tx = optax.chain(optax.scale_by_adam(mu_dtype=jnp.bfloat16),
+                     optax.scale_by_schedule(lr_warmup),
+                     optax.scale(-1.0))
+    opt_state = tx.init(params)
+    
+    # Data parallelism: parameters and optimizer state are replicated, batches
+    # are split along their first axis across all available devices
+    mesh = jax.sharding.Mesh(np.array(jax.devices()), ('batch',))
+    replicated = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec())
+    batch_sharding = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec('batch'))
+    stacked_batch_sharding = jax.sharding.NamedSharding(
+        mesh, jax.sharding.PartitionSpec(None, 'batch'))
+    params = jax.device_put(params, replicated)
+    opt_state = jax.device_put(opt_state, replicated)
     
     # Helper functions for training
-    bits_per_dims_norm = np.log(2.) * num_channels * image_size**2
-    @jax.jit
+    # Inverse of the bits per dimension normalization, log(2) * number of dimensions
+    inv_norm = np.float32(1. / (np.log(2.) * num_channels * image_size**2))
+    # Not jitted on its own: only traced as part of train_step / eval_step
     def get_logpx(z, logdets, priors):
         logpz = get_logpz(z, priors)
-        logpz = jnp.mean(logpz) / bits_per_dims_norm        # bits per dimension normalization
-        logdets = jnp.mean(logdets) / bits_per_dims_norm
+        logpz = jnp.mean(logpz) * inv_norm                  # bits per dimension normalization
+        logdets = jnp.mean(logdets) * inv_norm
         logpx = logpz + logdets - num_bits                  # num_bits: dequantization factor
         return logpx, logpz, logdets
         
-    @jax.jit
-    def train_step(opt, batch):
-        def loss_fn(params):
-            _, z, logdets, priors = model.apply(params, batch, reverse=False)
+    def update(carry, batch):
+        params, opt_state = carry
+        def loss_fn(params, microbatch):
+            _, z, logdets, priors = model.apply(params, microbatch, reverse=False)
             logpx, logpz, logdets = get_logpx(z, logdets, priors)
             return - logpx, (logpz, logdets)
-        logs, grad = jax.value_and_grad(loss_fn, has_aux=True)(opt.target)
-        opt = opt.apply_gradient(grad, learning_rate=lr_warmup(opt.state.step))
-        return logs, opt
+        
+        # Accumulate gradients over microbatches, then apply a single update
+        def accumulate(grad_sum, microbatch):
+            logs, grad = jax.value_and_grad(loss_fn, has_aux=True)(params, microbatch)
+            return jax.tree_util.tree_map(jnp.add, grad_sum, grad), logs
+        
+        # Strided microbatches (sample i goes to microbatch i % grad_accum_steps), so
+        # that each one stays split across all devices along the sharded batch axis
+        microbatches = jnp.swapaxes(
+            jnp.reshape(batch, (-1, grad_accum_steps) + batch.shape[1:]), 0, 1)
+        grad, logs = jax.lax.scan(accumulate, jax.tree_util.tree_map(jnp.zeros_like, params),
+                                  microbatches)
+        grad = jax.tree_util.tree_map(lambda g: g / grad_accum_steps, grad)
+        logs = jax.tree_util.tree_map(lambda l: jnp.mean(l, axis=0), logs)
+        updates, opt_state = tx.update(grad, opt_state, params)
+        params = optax.apply_updates(params, updates)
+        return (params, opt_state), logs
+    
+    # Runs one update per stacked batch in a single call; returns the last logs.
+    # params and opt_state are donated: their buffers are reused for the updated values
+    @partial(jax.jit,
+             in_shardings=(replicated, replicated, stacked_batch_sharding),
+             out_shardings=(replicated, replicated, replicated),
+             donate_argnums=(0, 1))
+    def train_step(params, opt_state, batches):
+        (params, opt_state), logs = jax.lax.scan(update, (params, opt_state), batches)
+        return jax.tree_util.tree_map(lambda l: l[-1], logs), params, opt_state
     
     # Helper functions for evaluation 
-    @jax.jit
+    # Nothing is donated here: params are still used for training after evaluation
+    @partial(jax.jit, in_shardings=(replicated, batch_sharding), out_shardings=replicated)
     def eval_step(params, batch):
         _, z, logdets, priors = model.apply(params, batch, reverse=False)
         return - get_logpx(z, logdets, priors)[0]
     
     # Helper function for sampling from random latent fixed during training for comparison
-    eps = []
     if not os.path.exists("samples"): os.makedirs("samples")
     if not os.path.exists("weights"): os.makedirs("weights")
-    for i in range(L):
-        expected_h = image_size // 2**(i + 1)
-        expected_c = num_channels * 2**(i + 1)
-        if i == L - 1: expected_c *= 2
-        eps.append(jax.random.normal(key, (num_samples, expected_h, expected_h, expected_c)))
+    # Latent shapes at each scale, and one independent key per scale
+    eps_shapes = [(num_samples,
+                   image_size // 2**(i + 1),
+                   image_size // 2**(i + 1),
+                   num_channels * 2**(i + 1) * (2 if i == L - 1 else 1)) for i in range(L)]
+    eps_keys = jax.random.split(key, L)
+    eps = tuple(jax.random.normal(k, shape) for k, shape in zip(eps_keys, eps_shapes))
+    # Placed like the parameters once, so every sample dump reuses the same buffers
+    eps = jax.device_put(eps, replicated)
+    
+    # Compiled once, then reused for every sample dump during training. No donation:
+    # eps is reused across dumps, and no output has the shape of zL anyway
+    reverse_fn = make_reverse_fn(model)
+    
     sample_fn = partial(sample, eps=eps, key=key, display=False,
                         sampling_temperature=sampling_temperature,
+                        reverse_fn=reverse_fn,
                         postprocess_fn=partial(postprocess, num_bits=num_bits))
     
     # Train
@@ -450,32 +580,45 @@ def train_glow(train_ds,
     print("Available jax devices:", jax.devices())
     print()
     bits = 0.
+    sample_interval = max(1, int(num_sample_epochs * steps_per_epoch))
+    # Stacks of `steps_per_call` batches (the last call of an epoch may be shorter),
+    # copied to device ahead of time
+    call_sizes = [min(steps_per_call, steps_per_epoch - i)
+                  for i in range(0, steps_per_epoch, steps_per_call)]
+    host_batches = (np.stack([next(train_ds) for _ in range(n)])
+                    for _ in range(num_epochs) for n in call_sizes)
+    device_batches = prefetch_to_device(host_batches, stacked_batch_sharding, size=2)
     start = time.time()
     try:
         for epoch in range(num_epochs):
             # train
-            for i in range(steps_per_epoch):
-                batch = next(train_ds)
-                loss, opt = train_step(opt, batch)
-                print(f"\r\033[92m[Epoch {epoch + 1}/{num_epochs}]\033[0m"
-                      f"\033[93m[Batch {i + 1}/{steps_per_epoch}]\033[0m"
-                      f" loss = {loss[0]:.5f},"
-                      f" (log(p(z)) = {loss[1][0]:.5f},"
-                      f" logdet = {loss[1][1]:.5f})", end='')
-                if np.isnan(loss[0]):
-                    print("\nModel diverged - NaN loss")
-                    return None, None
+            for i in range(0, steps_per_epoch, steps_per_call):
+                num_steps = min(steps_per_call, steps_per_epoch - i)
+                batches = next(device_batches)
+                loss, params, opt_state = train_step(params, opt_state, batches)
+                step = epoch * steps_per_epoch + i + num_steps
                 
-                step = epoch * steps_per_epoch + i + 1
-                if step % int(num_sample_epochs * steps_per_epoch) == 0:
-                    sample_fn(model, opt.target, 
+                # Only sync with the device every few steps
+                if step // log_every > (step - num_steps) // log_every or step % steps_per_epoch == 0:
+                    loss = jax.device_get(loss)
+                    print(f"\r\033[92m[Epoch {epoch + 1}/{num_epochs}]\033[0m"
+                          f"\033[93m[Batch {i + num_steps}/{steps_per_epoch}]\033[0m"
+                          f" loss = {loss[0]:.5f},"
+                          f" (log(p(z)) = {loss[1][0]:.5f},"
+                          f" logdet = {loss[1][1]:.5f})", end='')
+                    if np.isnan(loss[0]):
+                        print("\nModel diverged - NaN loss")
+                        return None, None
+                
+                if step // sample_interval > (step - num_steps) // sample_interval:
+                    sample_fn(model, params, 
                               save_path=f"samples/step_{step:05d}.png")
 
             # eval on one batch of validation samples 
             # + generate random sample
             t = time.time() - start
             if val_ds is not None:
-                bits = eval_step(opt.target, next(val_ds))
+                bits = eval_step(params, jax.device_put(next(val_ds), batch_sharding))
             print(f"\r\033[92m[Epoch {epoch + 1}/{num_epochs}]\033[0m"
                   f"[{int(t // 3600):02d}h {int((t % 3600) // 60):02d}mn]"
                   f" train_bits/dims = {loss[0]:.3f},"
@@ -484,14 +627,15 @@ def train_glow(train_ds,
             # Save parameters
             if (epoch + 1) % num_save_epochs == 0 or epoch == num_epochs - 1:
                 with open(f'weights/model_epoch={epoch + 1:03d}.weights', 'wb') as f:
-                    f.write(flax.serialization.to_bytes(opt.target))
+                    # Single host transfer of the (replicated) parameters
+                    f.write(flax.serialization.to_bytes(jax.device_get(params)))
     except KeyboardInterrupt:
         print(f"\nInterrupted by user at epoch {epoch + 1}")
         
     # returns final model and parameters
-    return model, opt.target
+    return model, params
 
-"""**Note on multi-devices training:** To extend the code for training on multi-devices we can make use of the `jax.vmap` operator (parallelize across XLA devices) instead of `jax.jit`, we also need to share the current parameters with all the devices (use `flax.jax_utils.replicate` on the optimizer before training), and finally to split the data across the devices, which can be handled with the `tf.data` in the input pipeline. [There is a more complete tutorial with an example here](https://flax.readthedocs.io/en/stable/howtos/ensembling.html)
+"""**Note on multi-devices training:** The training step above is data-parallel across all available devices: parameters and optimizer state are replicated via a `jax.sharding.NamedSharding` with an empty partition spec, and each batch is split along its first axis over a one-dimensional device mesh. `jax.jit` then takes care of inserting the gradient all-reduce. On a single device this is equivalent to plain `jax.jit`. [See the jax documentation on distributed arrays](https://jax.readthedocs.io/en/latest/notebooks/Distributed_arrays_and_automatic_parallelization.html)
 
 # Experiments
 
@@ -514,6 +658,11 @@ config_dict = {
     'L': 3,
     'nn_width': 512, 
     'learn_top_prior': True,
+    'grad_accum_steps': 1,
+    'steps_per_call': 1,
+    'remat': False,
+    'dtype': jnp.float32,
+    'scan_flows': False,
     'sampling_temperature': 0.7,
     'init_lr': 1e-3,
     'num_epochs': 13,
@@ -533,68 +682,98 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 tf.config.experimental.set_visible_devices([], 'GPU')
 
-def get_train_dataset(image_path, image_size, num_bits, batch_size, skip=None, **kwargs):
+def list_image_files(image_path, seed=0):
+    """List the images in image_path once, in a shuffled but fixed order (for a
+    given seed), so that the train/val split is both random and reproducible"""
+    files = tf.io.matching_files(f"{image_path}/*.jpg")
+    return tf.random.experimental.stateless_shuffle(files, seed=[seed, 0])
+
+
+def get_train_dataset(image_path, image_size, num_bits, batch_size, skip=None,
+                      cache_path="", files=None, **kwargs):
+    """Decoded and quantized images are cached after the first epoch, in memory
+    or in `cache_path` if given. Dequantization noise is resampled every epoch.
+    `files` (tensor of image paths) can be given to avoid listing image_path again."""
     del kwargs
-    train_ds = tf.data.Dataset.list_files(f"{image_path}/*.jpg")
+    if files is None:
+        files = list_image_files(image_path)
+    train_ds = tf.data.Dataset.from_tensor_slices(files)
     if skip is not None:
         train_ds = train_ds.skip(skip)
+    train_ds = train_ds.map(partial(decode_resize_fn, size=image_size, num_bits=num_bits),
+                            num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    train_ds = train_ds.cache(cache_path)
     train_ds = train_ds.shuffle(buffer_size=20000)
-    train_ds = train_ds.map(partial(map_fn, size=image_size, num_bits=num_bits, training=True))
-    train_ds = train_ds.batch(batch_size)
+    train_ds = train_ds.batch(batch_size, drop_remainder=True)
+    train_ds = train_ds.map(partial(dequantize_noise_fn, num_bits=num_bits, training=True),
+                            num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
     train_ds = train_ds.repeat()
+    train_ds = train_ds.prefetch(tf.data.AUTOTUNE)
     return iter(tfds.as_numpy(train_ds))
 
 
 def get_val_dataset(image_path, image_size, num_bits, batch_size, 
-                    take=None, repeat=False, **kwargs):
+                    take=None, repeat=False, cache_path="", files=None, **kwargs):
     del kwargs
-    val_ds = tf.data.Dataset.list_files(f"{image_path}/*.jpg")
+    if files is None:
+        files = list_image_files(image_path)
+    val_ds = tf.data.Dataset.from_tensor_slices(files)
     if take is not None:
         val_ds = val_ds.take(take)
-    val_ds = val_ds.map(partial(map_fn, size=image_size, num_bits=num_bits, training=False))
+    val_ds = val_ds.map(partial(decode_resize_fn, size=image_size, num_bits=num_bits),
+                        num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    val_ds = val_ds.cache(cache_path)
     val_ds = val_ds.batch(batch_size)
+    val_ds = val_ds.map(partial(dequantize_noise_fn, num_bits=num_bits, training=False),
+                        num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
     if repeat:
         val_ds = val_ds.repeat()
+    val_ds = val_ds.prefetch(tf.data.AUTOTUNE)
     return iter(tfds.as_numpy(val_ds))
 
-# Commented out IPython magic to ensure Python compatibility.
-# %%time
-num_images = len(glob.glob(f"{config_dict['image_path']}/*.jpg"))
-config_dict['steps_per_epoch'] = num_images // config_dict['batch_size']
-train_split = int(config_dict['train_split'] * num_images)
-print(f"{num_images} training images")
-print(f"{config_dict['steps_per_epoch']} training steps per epoch")
-
-#Train data
-train_ds = get_train_dataset(**config_dict, skip=train_split)
-
-# Val data
-# During training we'll only evaluate on one batch of validation
-# to save on computations
-val_ds = get_val_dataset(**config_dict, take=config_dict['batch_size'], repeat=True)
-
-# Sample
-plot_image_grid(postprocess(next(val_ds), num_bits=config_dict['num_bits'])[:25],
-                title="Input data sample")
+if __name__ == "__main__":
+    # Commented out IPython magic to ensure Python compatibility.
+    # %%time
+    # Single directory listing, shared by the train and val datasets
+    files = list_image_files(config_dict['image_path'])
+    num_images = int(tf.shape(files)[0])
+    config_dict['steps_per_epoch'] = num_images // config_dict['batch_size']
+    train_split = int(config_dict['train_split'] * num_images)
+    print(f"{num_images} training images")
+    print(f"{config_dict['steps_per_epoch']} training steps per epoch")
+
+    #Train data
+    train_ds = get_train_dataset(**config_dict, skip=train_split, files=files)
+
+    # Val data
+    # During training we'll only evaluate on one batch of validation
+    # to save on computations
+    val_ds = get_val_dataset(**config_dict, take=config_dict['batch_size'], repeat=True,
+                             files=files)
+
+    # Sample
+    plot_image_grid(postprocess(next(val_ds), num_bits=config_dict['num_bits'])[:25],
+                    title="Input data sample")
 
 """## Train"""
 
-model, params = train_glow(train_ds, val_ds=val_ds, **config_dict)
+if __name__ == "__main__":
+    model, params = train_glow(train_ds, val_ds=val_ds, **config_dict)
 
-print("Random samples evolution during training")
-from PIL import Image
+    print("Random samples evolution during training")
+    from PIL import Image
 
-# filepaths
-fp_in = "samples/step_*.png"
-fp_out = "sample_evolution.gif"
+    # filepaths
+    fp_in = "samples/step_*.png"
+    fp_out = "sample_evolution.gif"
 
-# https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#gif
-img, *imgs = [Image.open(f) for f in sorted(glob.glob(fp_in))]
-img.save(fp=fp_out, format='GIF', append_images=imgs,
-         save_all=True, duration=200, loop=0)
+    # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#gif
+    img, *imgs = [Image.open(f) for f in sorted(glob.glob(fp_in))]
+    img.save(fp=fp_out, format='GIF', append_images=imgs,
+             save_all=True, duration=200, loop=0)
 
-from IPython.core.display import display, HTML
-display(HTML('<img src="sample_evolution.gif">'))
+    from IPython.core.display import display, HTML
+    display(HTML('<img src="sample_evolution.gif">'))
 
 """### Evaluation"""
 
@@ -603,7 +782,8 @@ if False:
     model = GLOW(K=config_dict['K'],
                  L=config_dict['L'], 
                  nn_width=config_dict['nn_width'], 
-                 learn_top_prior=config_dict['learn_top_prior'])
+                 learn_top_prior=config_dict['learn_top_prior'],
+                 scan_flows=config_dict['scan_flows'])
 
     with open('weights/model_epoch=100.weights', 'rb') as f:
         params = model.init(random_key, jnp.zeros((config_dict['batch_size'],
@@ -621,17 +801,24 @@ def reconstruct(model, params, batch):
     plot_image_grid(rec, title="reconstructions")
     
 
+@partial(jax.jit, static_argnums=(1,))
+def interpolate_latents(z, num_samples):
+    """Linear interpolation between the two samples of each latent in z"""
+    t = jnp.linspace(0., 1., num_samples)
+    def lerp(zi):
+        z_1, z_2 = zi[0], zi[1]
+        ti = t.reshape((-1,) + (1,) * z_1.ndim)
+        return ti * z_1 + (1. - ti) * z_2
+    return jax.tree_util.tree_map(lerp, z)
+
+
 def interpolate(model, params, batch, num_samples=16):
     global config_dict
     i1, i2 = np.random.choice(range(batch.shape[0]), size=2, replace=False)
     in_ = np.stack([batch[i1], batch[i2]], axis=0)
     x, z, logdets, priors = model.apply(params, in_, reverse=False)
     # interpolate
-    interpolated_z = []
-    for zi in z:
-        z_1, z_2 = zi[:2]
-        interpolate = jnp.array([t * z_1 + (1 - t) * z_2 for t in np.linspace(0., 1., 16)])
-        interpolated_z.append(interpolate)
+    interpolated_z = interpolate_latents(z, num_samples)
     rec, *_ = model.apply(params, interpolated_z[-1], z=interpolated_z, reverse=True)
     rec = postprocess(rec, config_dict["num_bits"])
     plot_image_grid(rec, title="Linear interpolation")
@@ -640,31 +827,39 @@ def interpolate(model, params, batch, num_samples=16):
 As a sanity check let's first look at image reconstructions: since the model is invertible these should always be perfect, up to small float errors, except in very bad cases e.g. NaN values or other numerical errors
 """
 
-batch = next(val_ds)
-reconstruct(model, params, batch)
+if __name__ == "__main__":
+    batch = next(val_ds)
+    reconstruct(model, params, batch)
 
 """### Sampling
 Now let's take some random samples from the model, at different sampling temperatures
 """
 
-sample(model, params, shape=(16,) + config_dict["sampling_shape"],  key=random_key,
-       postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
-       save_path="samples/final_random_sample_T=1.png");
-
-sample(model, params, shape=(16,) + config_dict["sampling_shape"], 
-       key=jax.random.PRNGKey(1), sampling_temperature=0.7,
-       postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
-       save_path="samples/final_random_sample_T=0.7.png");
-
-sample(model, params, shape=(16,) + config_dict["sampling_shape"], 
-       key=jax.random.PRNGKey(2), sampling_temperature=0.7,
-       postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
-       save_path="samples/final_random_sample_T=0.7.png");
-
-sample(model, params, shape=(16,) + config_dict["sampling_shape"], 
-       key=jax.random.PRNGKey(3), sampling_temperature=0.5,
-       postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
-       save_path="samples/final_random_sample_T=0.5.png");
+if __name__ == "__main__":
+    # All these samples have the same shape: the reverse pass is compiled once
+    reverse_fn = make_reverse_fn(model)
+    sample(model, params, shape=(16,) + config_dict["sampling_shape"],  key=random_key,
+           postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
+           reverse_fn=reverse_fn,
+           save_path="samples/final_random_sample_T=1.png");
+
+    sample(model, params, shape=(16,) + config_dict["sampling_shape"], 
+           key=jax.random.PRNGKey(1), sampling_temperature=0.7,
+           postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
+           reverse_fn=reverse_fn,
+           save_path="samples/final_random_sample_T=0.7.png");
+
+    sample(model, params, shape=(16,) + config_dict["sampling_shape"], 
+           key=jax.random.PRNGKey(2), sampling_temperature=0.7,
+           postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
+           reverse_fn=reverse_fn,
+           save_path="samples/final_random_sample_T=0.7.png");
+
+    sample(model, params, shape=(16,) + config_dict["sampling_shape"], 
+           key=jax.random.PRNGKey(3), sampling_temperature=0.5,
+           postprocess_fn=partial(postprocess, num_bits=config_dict["num_bits"]),
+           reverse_fn=reverse_fn,
+           save_path="samples/final_random_sample_T=0.5.png");
 
 """### Latent space
 Finally, we can look at the linear interpolation in the learned latent space: We generate embedding $z_1$ and $z_2$ by feeding two validation set images to Glow. Then we plot the decoded images for latent vectors $t + z_1 + (1 - t) z_2$ for $t \in [0, 1]$ (at all level of the latent hierarchy).
@@ -674,6 +869,7 @@ Finally, we can look at the linear interpolation in the learned latent space: We
 In the original paper, this allows them to do "semantic manipulation" on the Celeba dataset by building representative centroid vectors for different attributes/classes (e.g.g $z_{smiling}$ and $z_{non-smiling}$). They can use then use the vector direction $z_{smiling}$ - $z_{non-smiling}$ as a guide to browse the latent space (in that example, to make images more or less "smiling").
 """
 
-interpolate(model, params, batch)
+if __name__ == "__main__":
+    interpolate(model, params, batch)
 
-interpolate(model, params, batch)
+    interpolate(model, params, batch)
@@ -28,6 +28,13 @@ def unsqueeze(x):
     return x
 
 
+def split_channels(x):
+    """Split x in two halves along the channel (last) axis. Plain slices
+    (rather than jnp.split) which XLA can usually fuse without a copy"""
+    c = x.shape[-1] // 2
+    return x[..., :c], x[..., c:]
+
+
 ### From one scale to another: split / unsplit, with learnable prior
 class ConvZeros(nn.Module):
     features: int
@@ -59,7 +66,7 @@ class Split(nn.Module):
         """
         if not reverse:
             del z, eps, temperature
-            z, x = jnp.split(x, 2, axis=-1)
+            z, x = split_channels(x)
             
         # Learn the prior parameters for z
         prior = ConvZeros(x.shape[-1] * 2, name="conv_prior")(x)
@@ -71,7 +78,7 @@ class Split(nn.Module):
                 if eps is None:
                     eps = jax.random.normal(self.key, x.shape) 
                 eps *= temperature
-                mu, logsigma = jnp.split(prior, 2, axis=-1)
+                mu, logsigma = split_channels(prior)
                 z = eps * jnp.exp(logsigma) + mu
             return jnp.concatenate([z, x], axis=-1)
         # Forward mode: Also return the prior as it is used to compute the loss
@@ -84,21 +91,24 @@ class AffineCoupling(nn.Module):
     out_dims: int
     width: int = 512
     eps: float = 1e-8
+    dtype: jnp.dtype = jnp.float32                    # Computation dtype of the hidden convs
     
     @nn.compact
     def __call__(self, inputs, logdet=0, reverse=False):
         # Split
-        xa, xb = jnp.split(inputs, 2, axis=-1)
+        xa, xb = split_channels(inputs)
         
         # NN
+        # The hidden convs run in `dtype` (params stay float32); the output conv
+        # and the logdet are computed in float32 for numerical stability
         net = nn.Conv(features=self.width, kernel_size=(3, 3), strides=(1, 1),
-                      padding='same', name="ACL_conv_1")(xb)
+                      padding='same', dtype=self.dtype, name="ACL_conv_1")(xb)
         net = nn.relu(net)
         net = nn.Conv(features=self.width, kernel_size=(1, 1), strides=(1, 1),
-                      padding='same', name="ACL_conv_2")(net)
+                      padding='same', dtype=self.dtype, name="ACL_conv_2")(net)
         net = nn.relu(net)
-        net = ConvZeros(self.out_dims, name="ACL_conv_out")(net)
-        mu, logsigma = jnp.split(net, 2, axis=-1)
+        net = ConvZeros(self.out_dims, name="ACL_conv_out")(net.astype(jnp.float32))
+        mu, logsigma = split_channels(net)
         # See https://github.com/openai/glow/blob/master/model.py#L376
         # sigma = jnp.exp(logsigma)
         sigma = jax.nn.sigmoid(logsigma + 2.)
@@ -161,6 +171,7 @@ class ActNorm(nn.Module):
 class Conv1x1(nn.Module):
     channels: int
     key: jax.random.PRNGKey = jax.random.PRNGKey(0)
+    dtype: jnp.dtype = jnp.float32                    # Computation dtype of the forward 1x1 conv
 
     def setup(self):
         """Initialize P, L, U, s"""
@@ -179,8 +190,11 @@ class Conv1x1(nn.Module):
         s = jnp.diag(u)
         self.sign_s = jnp.sign(s)
         S_log_init = jnp.log(jnp.abs(s))
+        # Fixed masks (non-trainable); setup reruns on every apply, but under jit
+        # these are constants folded into the compiled graph
         self.l_mask = jnp.tril(jnp.ones((c, c)), k=-1)
         self.u_mask = jnp.transpose(self.l_mask)
+        self.eye = jnp.eye(c)
         # Define trainable variables
         self.L = self.param("L", lambda k, sh: L_init, (c, c))
         self.U = self.param("U", lambda k, sh: U_init, (c, c))
@@ -191,26 +205,26 @@ class Conv1x1(nn.Module):
         c = self.channels
         assert c == inputs.shape[-1]
         # enforce constraints that L and U are triangular
-        # in the LU decomposition
-        L = self.L * self.l_mask + jnp.eye(c)
+        # in the LU decomposition. W and the logdet (log_s) are always computed
+        # in float32; only the forward matmul itself runs in `dtype`
+        L = self.L * self.l_mask + self.eye
         U = self.U * self.u_mask + jnp.diag(self.sign_s * jnp.exp(self.log_s))
         logdet_factor = inputs.shape[1] * inputs.shape[2]
         
-        # forward
+        # forward: a 1x1 convolution is a CxC matmul applied to every pixel
         if not reverse:
-            # lax.conv uses weird ordering: NCHW and OIHW
             W = jnp.matmul(self.P, jnp.matmul(L, U))
-            y = jax.lax.conv(jnp.transpose(inputs, (0, 3, 1, 2)), 
-                             W[..., None, None], (1, 1), 'same')
-            y = jnp.transpose(y, (0, 2, 3, 1))
+            y = jnp.einsum('bhwi,oi->bhwo', inputs.astype(self.dtype), W.astype(self.dtype),
+                           preferred_element_type=jnp.float32)
             logdet += jnp.sum(self.log_s) * logdet_factor
-        # inverse
+        # inverse: W = PLU, hence x = U^-1 L^-1 P^-1 y, computed with two
+        # triangular solves (in float32) rather than explicit matrix inverses
         else:
-            W_inv = jnp.matmul(jax.scipy.linalg.inv(U), jnp.matmul(
-                jax.scipy.linalg.inv(L), self.P_inv))
-            y = jax.lax.conv(jnp.transpose(inputs, (0, 3, 1, 2)),
-                             W_inv[..., None, None], (1, 1), 'same')
-            y = jnp.transpose(y, (0, 2, 3, 1))
+            y = jnp.matmul(self.P_inv, jnp.reshape(inputs, (-1, c)).T)
+            y = jax.lax.linalg.triangular_solve(L, y, left_side=True, lower=True,
+                                                unit_diagonal=True)
+            y = jax.lax.linalg.triangular_solve(U, y, left_side=True, lower=False)
+            y = jnp.reshape(y.T, inputs.shape)
             logdet -= jnp.sum(self.log_s) * logdet_factor
             
         return y, logdet
\ No newline at end of file
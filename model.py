@@ -4,40 +4,85 @@ import flax.linen as nn
 from layers import ConvZeros
 from layers import ActNorm, Conv1x1, AffineCoupling
 from layers import squeeze, unsqueeze, Split
+from layers import split_channels
 
 ### Flow
 class FlowStep(nn.Module):
     nn_width: int = 512
     key: jax.random.PRNGKey = jax.random.PRNGKey(0)
+    remat: bool = False                               # If true, recompute ACL activations in backward
+    dtype: jnp.dtype = jnp.float32                    # Computation dtype of the ACL and 1x1 convs
         
     @nn.compact
     def __call__(self, x, logdet=0, reverse=False):
         out_dims = x.shape[-1]
+        # Rematerialization trades compute for activation memory. `reverse` is
+        # passed positionally as it needs to be static (argnum 3, counting self)
+        coupling = AffineCoupling
+        if self.remat:
+            coupling = nn.remat(AffineCoupling, static_argnums=(3,),
+                                policy=jax.checkpoint_policies.dots_with_no_batch_dims_saveable)
         if not reverse:
             x, logdet = ActNorm()(x, logdet=logdet, reverse=False)
-            x, logdet = Conv1x1(out_dims, self.key)(x, logdet=logdet, reverse=False)
-            x, logdet = AffineCoupling(out_dims, self.nn_width)(x, logdet=logdet, reverse=False)
+            x, logdet = Conv1x1(out_dims, self.key, self.dtype)(x, logdet=logdet, reverse=False)
+            x, logdet = coupling(out_dims, self.nn_width, dtype=self.dtype,
+                                 name="AffineCoupling_0")(x, logdet, False)
         else:
-            x, logdet = AffineCoupling(out_dims, self.nn_width)(x, logdet=logdet, reverse=True)
-            x, logdet = Conv1x1(out_dims, self.key)(x, logdet=logdet, reverse=True)
+            x, logdet = coupling(out_dims, self.nn_width, dtype=self.dtype,
+                                 name="AffineCoupling_0")(x, logdet, True)
+            x, logdet = Conv1x1(out_dims, self.key, self.dtype)(x, logdet=logdet, reverse=True)
             x, logdet = ActNorm()(x, logdet=logdet, reverse=True)
         return x, logdet
     
     
+class ScannedFlowStep(nn.Module):
+    """FlowStep with a (carry, input) -> (carry, output) signature for nn.scan"""
+    nn_width: int = 512
+    key: jax.random.PRNGKey = jax.random.PRNGKey(0)
+    remat: bool = False
+    dtype: jnp.dtype = jnp.float32
+    reverse: bool = False
+    
+    @nn.compact
+    def __call__(self, carry, _):
+        x, logdet = carry
+        x, logdet = FlowStep(self.nn_width, self.key, self.remat, self.dtype, name="step")(
+            x, logdet=logdet, reverse=self.reverse)
+        return (x, logdet), None
+    
+    
 ### Glow model
 class GLOW(nn.Module):
     K: int = 32                                       # Number of flow steps
     L: int = 3                                        # Number of scales
     nn_width: int = 512                               # NN width in Affine Coupling Layer
     learn_top_prior: bool = False                     # If true, learn prior N(mu, sigma) for zL
+    remat: bool = False                               # If true, rematerialize ACL activations
+    dtype: jnp.dtype = jnp.float32                    # e.g. jnp.bfloat16 for mixed precision convs
+    scan_flows: bool = False                          # If true, nn.scan the K flow steps (faster compile)
     key: jax.random.PRNGKey = jax.random.PRNGKey(0)
         
         
     def flows(self, x, logdet=0, reverse=False, name=""):
         """K subsequent flows. Called at each scale."""
+        if self.scan_flows:
+            # The K steps are traced and compiled once; their parameters are
+            # stacked along a leading axis. The reverse pass iterates over them
+            # backward, and shares them by using the same module name
+            scanned_steps = nn.scan(ScannedFlowStep,
+                                    variable_axes={'params': 0},
+                                    split_rngs={'params': True},
+                                    length=self.K,
+                                    reverse=reverse)
+            # The scan carry needs a fixed type: logdet is a (batch,) float32 array
+            logdet = jnp.zeros(x.shape[:1], jnp.float32) + logdet
+            (x, logdet), _ = scanned_steps(self.nn_width, self.key, self.remat, self.dtype,
+                                           reverse, name=f"{name}/steps")((x, logdet), None)
+            return x, logdet
         for k in range(self.K):
             it = k + 1 if not reverse else self.K - k
-            x, logdet = FlowStep(self.nn_width, self.key, name=f"{name}/step_{it}")(
+            x, logdet = FlowStep(self.nn_width, self.key, self.remat, self.dtype,
+                                 name=f"{name}/step_{it}")(
                 x, logdet=logdet, reverse=reverse)
         return x, logdet
         
@@ -75,7 +120,7 @@ class GLOW(nn.Module):
                     # If not learnable, the model just uses the input x directly
                     # see https://github.com/openai/glow/blob/master/model.py#L109
                     prior = ConvZeros(x.shape[-1] * 2, name="prior_top")(jnp.zeros(x.shape))
-                    mu, logsigma = jnp.split(prior, 2, axis=-1)
+                    mu, logsigma = split_channels(prior)
                     x = x * jnp.exp(logsigma) + mu
                 
         ## Multi-scale model
@@ -12,8 +12,8 @@ from functools import partial
 def postprocess(x, num_bits):
     """Map [-0.5, 0.5] quantized images to uint space"""
     num_bins = 2 ** num_bits
-    x = jnp.floor((x + 0.5) * num_bins)
-    x *= 256. / num_bins
+    x = jnp.floor((x + 0.5) * num_bins).astype(jnp.int32)
+    x = x * (256 // num_bins)
     return jnp.clip(x, 0, 255).astype(jnp.uint8)
 
 def sample(model, 
@@ -1,9 +1,11 @@
 import jax
 import flax
+import itertools
+import collections
 
 import numpy as np
 from matplotlib import pyplot as plt
-from mpl_toolkits.axes_grid1 import ImageGrid
+from matplotlib.figure import Figure
 
 # Utils to display Jax model in a similar way as flax summary
 def get_params_size(v, s=0):
@@ -35,20 +37,53 @@ def summarize_jax_model(variables,
             print('-' * (col1_size + col2_size))
             
             
+# Input pipeline utils
+def prefetch_to_device(iterator, sharding, size=2):
+    """Transfer the next `size` elements of iterator to device ahead of time,
+    so that the host-to-device copy overlaps with the current computation"""
+    queue = collections.deque()
+    def enqueue(n):
+        for x in itertools.islice(iterator, n):
+            queue.append(jax.device_put(x, sharding))
+    enqueue(size)
+    while queue:
+        yield queue.popleft()
+        enqueue(1)
+            
+            
+def image_montage(y):
+    """Tile the first num_rows**2 images of a (N, H, W, C) batch into a single
+    (num_rows * H, num_rows * W, C) image"""
+    y = np.asarray(y)
+    num_rows = int(np.floor(np.sqrt(y.shape[0])))
+    h, w = y.shape[1:3]
+    y = y[:num_rows**2].reshape((num_rows, num_rows) + y.shape[1:])
+    montage = y.transpose(0, 2, 1, 3, 4).reshape(num_rows * h, num_rows * w, -1)
+    return montage[..., 0] if montage.shape[-1] == 1 else montage
+
+
+# Figures reused across calls of plot_image_grid when not displaying
+# (e.g. periodic sample dumps during training), keyed by (figsize, montage shape).
+# They are not registered with pyplot, hence never shown by a later plt.show()
+_FIGURE_CACHE = {}
+
 def plot_image_grid(y, title=None, display=True, save_path=None, figsize=(10, 10)):
     """Plot and optionally save an image grid with matplotlib"""
-    fig = plt.figure(figsize=figsize)
-    num_rows = int(np.floor(np.sqrt(y.shape[0])))
-    grid = ImageGrid(fig, 111, nrows_ncols=(num_rows, num_rows), axes_pad=0.1)
-    for ax in grid: 
+    montage = image_montage(y)
+    cache_key = (figsize, montage.shape)
+    if display or cache_key not in _FIGURE_CACHE:
+        fig = plt.figure(figsize=figsize) if display else Figure(figsize=figsize)
+        ax = fig.add_subplot(111)
         ax.set_axis_off()
-    for ax, im in zip(grid, y):
-        ax.imshow(im)
+        image = ax.imshow(montage)
+        if not display:
+            _FIGURE_CACHE[cache_key] = (fig, image)
+    else:
+        fig, image = _FIGURE_CACHE[cache_key]
+        image.set_data(montage)
     fig.suptitle(title, fontsize=18)
     fig.subplots_adjust(top=0.98)
     if save_path is not None:
-        plt.savefig(save_path, bbox_inches="tight")
+        fig.savefig(save_path, bbox_inches="tight")
     if display:
         plt.show()
-    else:
-        plt.close()
\ No newline at end of file